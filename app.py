@@ -1,34 +1,71 @@
-from flask import Flask, request
+from flask import Flask, request, send_file
 from flasgger import Swagger, swag_from
 from PIL import Image
+from werkzeug.security import safe_join
 import io
 from io import BytesIO
-import base64
+import math
+import mmap
+import multiprocessing
+import pybase64
 import os
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
 
 app = Flask(__name__)
 Swagger(app)
 
-# Function to get image data and size
-def get_image_data_size(image_path):
-  # Read the image data from the file in binary mode
+# Worker processes for the CPU-bound resize and encode, so requests are not serialized on the GIL.
+# Workers start lazily from request threads, so avoid forking a multithreaded process
+_pool_context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+_pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=_pool_context)
+_pool_lock = threading.Lock()
+
+# Folder the images are served from
+IMAGES_DIR = 'images'
+
+# Image file extensions listed by get_images
+ALLOWED_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png'})
+
+# Image file extensions that can be sent as image/jpeg without re-encoding
+JPEG_EXTENSIONS = frozenset({'.jpg', '.jpeg'})
+
+# Resampling filter used when resizing
+LANCZOS = Image.Resampling.LANCZOS
+
+# Function to get the absolute path of an image in the images folder (None if the name escapes it)
+def get_image_path(image_name):
+  return safe_join(os.path.abspath(IMAGES_DIR), image_name)
+
+# Function to encode an image file as base64 without reading it into memory first
+def encode_image_file(image_path):
+  # Map the file so the encoder reads straight from the page cache
   with open(image_path, 'rb') as file:
-    image_data = file.read()
-  
-  image_size_kb = len(image_data) / 1024
+    # Empty files cannot be mapped and encode to an empty string
+    if os.fstat(file.fileno()).st_size == 0:
+      return ''
 
-  return image_data, image_size_kb
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as image_data:
+      return pybase64.b64encode_as_string(image_data)
 
-# Function to compress an image and return it as base64-encoded string
-def compress_image(image_path, max_size_kb, target_dimension, quality):
-  
-  # Get image data and image size 
-  image_data, current_size_kb = get_image_data_size(image_path)
+# Function to compress an image and return it as an in-memory JPEG buffer
+def compress_image_buffer(image_path, current_size_kb, max_size_kb, target_dimension, quality):
+
+  # Resize the image (Pillow reads the file lazily, so draft applies before decoding)
+  # and release the source file and full-size pixels as soon as the resize is done
+  with Image.open(image_path) as original_image:
+    # Let libjpeg scale JPEGs down during decoding (no-op for other formats)
+    original_image.draft('RGB', target_dimension)
+
+    # Let Pillow box-reduce large downscales first while keeping a margin for the Lanczos pass
+    resized_image = original_image.resize(target_dimension, LANCZOS, reducing_gap=3.0)
 
-  # Resize the image
-  original_image = Image.open(io.BytesIO(image_data))
-  resized_image = original_image.resize(target_dimension, Image.Resampling.LANCZOS)
+  # JPEG cannot store alpha or palette images, so convert anything other than RGB/grayscale
+  if resized_image.mode not in ('RGB', 'L'):
+    resized_image = resized_image.convert('RGB')
 
   # Calculate the compression factor based on the target size
   compression_factor = (max_size_kb / current_size_kb) * 100
@@ -39,30 +76,103 @@ def compress_image(image_path, max_size_kb, target_dimension, quality):
   # Ensure the quality parameter is within a valid range
   quality = max(1, min(quality, 95))
 
-    # Compress the image
+  # Compress the image (optimized Huffman tables, progressive scans and 4:2:0 chroma subsampling
+  # give a smaller file at the same quality; drop optimize=True if CPU matters more than bytes)
   compressed_image = io.BytesIO()
-  resized_image.save(compressed_image, format='JPEG', quality=quality)
+  resized_image.save(compressed_image, format='JPEG', quality=quality, optimize=True, progressive=True, subsampling=2)
+
+  # JPEG size is not linear in the source size, so if the first estimate is over the target
+  # (max_size_kb is an upper limit) or more than 15% under it, re-encode once with the quality
+  # scaled by the square root of the size ratio
+  target_size = max_size_kb * 1024
+  actual_size = compressed_image.getbuffer().nbytes
+  if target_size > 0 and (actual_size > target_size or (target_size - actual_size) / target_size > 0.15):
+    retry_quality = max(1, min(int(quality * math.sqrt(target_size / actual_size)), 95))
+
+    # Skip the retry if clamping left the quality unchanged
+    if retry_quality != quality:
+      retry_image = io.BytesIO()
+      resized_image.save(retry_image, format='JPEG', quality=retry_quality, optimize=True, progressive=True, subsampling=2)
+
+      # Keep the first encode if it fit and the retry does not
+      if retry_image.getbuffer().nbytes <= target_size or actual_size > target_size:
+        compressed_image = retry_image
+
+  compressed_image.seek(0)
+
+  return compressed_image
+
+
+# Function run in a worker process to compress an image and return the JPEG bytes
+def _compress_image_bytes(image_path, current_size_kb, max_size_kb, target_dimension, quality):
+  return compress_image_buffer(image_path, current_size_kb, max_size_kb, target_dimension, quality).getvalue()
+
+
+# Function to replace the worker pool once a worker has died and left it unusable
+def _replace_broken_pool(broken_pool):
+  global _pool
+  with _pool_lock:
+    # Another request may already have replaced it
+    if _pool is broken_pool:
+      broken_pool.shutdown(wait=False)
+      _pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=_pool_context)
+
+
+# Function to compress an image in a worker process, cached per file version and parameters
+@lru_cache(maxsize=256)
+def _do_compress(image_path, mtime_ns, current_size_kb, target_width, target_height, max_size_kb, quality):
+  args = (image_path, current_size_kb, max_size_kb, (target_width, target_height), quality)
+
+  pool = _pool
+  try:
+    future = pool.submit(_compress_image_bytes, *args)
+  except BrokenProcessPool:
+    # An earlier worker crash broke the pool; this request never ran, so retry it on a new pool
+    _replace_broken_pool(pool)
+    pool = _pool
+    future = pool.submit(_compress_image_bytes, *args)
+
+  try:
+    return future.result()
+  except BrokenProcessPool:
+    # A worker died while this request was in flight (e.g. killed or out of memory on a large
+    # decode): replace the pool for later requests and fail only this one
+    _replace_broken_pool(pool)
+    raise
+
+
+# Function to compress an image and return the JPEG bytes
+def compress_image_data(image_path, current_size_kb, max_size_kb, target_dimension, quality):
+  # The modification time invalidates cached results when the file changes
+  mtime_ns = os.stat(image_path).st_mtime_ns
+  target_width, target_height = target_dimension
+
+  return _do_compress(image_path, mtime_ns, current_size_kb, target_width, target_height, max_size_kb, quality)
+
+
+# Function to compress an image and return it as base64-encoded string
+def compress_image(image_path, current_size_kb, max_size_kb, target_dimension, quality):
+  compressed_image_data = compress_image_data(image_path, current_size_kb, max_size_kb, target_dimension, quality)
 
   # Get the size of the compressed image in KB
-  compressed_image_size = compressed_image.getbuffer().nbytes / 1024 
+  compressed_image_size = len(compressed_image_data) / 1024 
 
-  compressed_image_base64 = base64.b64encode(compressed_image.getvalue()).decode('utf-8')
+  # Encode outside the cache so only the compact JPEG bytes are kept in memory
+  compressed_image_base64 = pybase64.b64encode_as_string(compressed_image_data)
 
   return compressed_image_size, compressed_image_base64
 
 
 # Function to convert image to base64 and return it as base64-encoded string
 def convert_to_grayscale(image_path):
-  # Open the image file
-  original_image = Image.open(image_path)
-  
-  # Convert the image to grayscale
-  grayscale_image = original_image.convert("L")
+  # Open the image file and convert it to grayscale
+  with Image.open(image_path) as original_image:
+    grayscale_image = original_image.convert("L")
   
   # Convert grayscale image to base64
   with BytesIO() as buffer:
     grayscale_image.save(buffer, format="JPEG")
-    grayscale_image_base64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
+    grayscale_image_base64 = pybase64.b64encode_as_string(buffer.getbuffer())
 
   # Get image size
   grayscale_image_size = len(grayscale_image_base64) / 1024
@@ -125,7 +235,7 @@ def get_compressed_image():
                 description: Error message.
   """
   try:
-    start_time = time.time()
+    start_time = time.monotonic_ns()
     
     # Get the image name as a parameter
     image_name = request.args.get('image_name')
@@ -136,40 +246,124 @@ def get_compressed_image():
     target_dimension = (target_width, target_height)
 
     # Construct the path to the image in the 'images' folder
-    image_path = os.path.join('images', image_name)
+    image_path = get_image_path(image_name)
 
     # Check if the image file exists
-    if not os.path.exists(image_path):
+    if image_path is None or not os.path.exists(image_path):
       return {'error': f'Image {image_name} not found'}, 404
 
-
     # Get the target size as a parameter (defaulting to 1024 KB if not provided)
     max_size_kb = int(request.args.get('max_size_kb', 1024))
 
-    # Get image data and size
-    image_data, image_size_kb = get_image_data_size(image_path)
+    # Get image size
+    image_size_kb = os.path.getsize(image_path) / 1024
 
     # Check if image size is less than max size
     if (image_size_kb <= max_size_kb):
-      # Encode the binary data of the image
-      encoded_image = base64.b64encode(image_data)
-      
-      # Convert the bytes to a UTF-8 string
-      image_base64 = encoded_image.decode('utf-8')
+      # Encode the image file to a base64 string
+      image_base64 = encode_image_file(image_path)
       return {"message":f"Image size is already less than {max_size_kb} KB", "image_base64": image_base64 }
 
     # Get the quality as a parameter (defaulting to 85 if not provided)
     quality = int(request.args.get('quality', 85))
 
     # Get the compressed image size, time taken and compressed image base64
-    compressed_image_size, compressed_image_base64 = compress_image(image_path, max_size_kb, target_dimension, quality) 
+    compressed_image_size, compressed_image_base64 = compress_image(image_path, image_size_kb, max_size_kb, target_dimension, quality)
 
-    end_time = time.time()
-
-    time_taken= (end_time - start_time) * 1000
+    time_taken = (time.monotonic_ns() - start_time) // 1_000_000
 
     # Return the JSON response
-    return {'time_elapsed': f'{int(time_taken)} ms', 'compressed_image_size': f'{compressed_image_size:.2f} KB', 'compressed_image_base64': compressed_image_base64}, 200
+    return {'time_elapsed': f'{time_taken} ms', 'compressed_image_size': f'{compressed_image_size:.2f} KB', 'compressed_image_base64': compressed_image_base64}, 200
+  except Exception as e:
+    return {'error': f'An error occured: {str(e)}'}, 500
+
+
+@app.route('/get_compressed_image_raw', methods=['GET'])
+@app.route('/compressed.jpg', methods=['GET'])
+def get_compressed_image_raw():
+  """
+  Endpoint to get a compressed image as raw JPEG bytes.
+  ---
+  parameters:
+    - name: image_name
+      in: query
+      type: string
+      description: Image name.
+      required: true
+    - name: max_size_kb
+      in: query
+      type: number
+      description: Target size for the compressed image in kilobytes.
+      required: true
+    - name: quality
+      in: query
+      type: number
+      description: Quality of the compressed image.
+      required: true
+    - name: target_width
+      in: query
+      type: number
+      description: Target width for the compressed image.
+      required: true
+    - name: target_height
+      in: query
+      type: number
+      description: Target height for the compressed image.
+      required: true
+  produces:
+    - image/jpeg
+  responses:
+    200:
+      description: Compressed image successfully retrieved.
+      content:
+        image/jpeg:
+          schema:
+            type: string
+            format: binary
+    404:
+      description: Image not found.
+      content:
+        application/json:
+          schema:
+            type: object
+            properties:
+              error:
+                type: string
+                description: Error message.
+  """
+  try:
+    # Get the image name as a parameter
+    image_name = request.args.get('image_name')
+
+    # Get the target dimension as a parameter
+    target_width = int(request.args.get('target_width'))
+    target_height = int(request.args.get('target_height'))
+    target_dimension = (target_width, target_height)
+
+    # Construct the path to the image in the 'images' folder
+    image_path = get_image_path(image_name)
+
+    # Check if the image file exists
+    if image_path is None or not os.path.exists(image_path):
+      return {'error': f'Image {image_name} not found'}, 404
+
+    # Get the target size as a parameter (defaulting to 1024 KB if not provided)
+    max_size_kb = int(request.args.get('max_size_kb', 1024))
+
+    # Send a JPEG untouched if it is already small enough; other formats are re-encoded so the
+    # response is always image/jpeg (a file path lets the WSGI server use its file wrapper,
+    # which gunicorn maps to sendfile)
+    image_size_kb = os.path.getsize(image_path) / 1024
+    if (image_size_kb <= max_size_kb and os.path.splitext(image_path)[1].lower() in JPEG_EXTENSIONS):
+      return send_file(image_path, mimetype='image/jpeg')
+
+    # Get the quality as a parameter (defaulting to 85 if not provided)
+    quality = int(request.args.get('quality', 85))
+
+    # Compress the image and send the JPEG bytes without base64 encoding
+    compressed_image_data = compress_image_data(image_path, image_size_kb, max_size_kb, target_dimension, quality)
+
+    return send_file(io.BytesIO(compressed_image_data), mimetype='image/jpeg')
   except Exception as e:
     return {'error': f'An error occured: {str(e)}'}, 500
 
@@ -209,27 +403,25 @@ def get_grayscale_image():
                 description: Error message.
   """
   try:
-    start_time = time.time()
+    start_time = time.monotonic_ns()
     
     # Get the image name as a parameter
     image_name = request.args.get('image_name')
 
     # Construct the path to the image in the 'images' folder
-    image_path = os.path.join('images', image_name)
+    image_path = get_image_path(image_name)
 
     # Check if the image file exists
-    if not os.path.exists(image_path):
+    if image_path is None or not os.path.exists(image_path):
       return {'error': f'Image {image_name} not found'}, 404
 
     # Convert the image to grayscale
     grayscale_image_base64, grayscale_image_size = convert_to_grayscale(image_path)
 
-    end_time = time.time()
-
-    time_taken= (end_time - start_time) * 1000
+    time_taken = (time.monotonic_ns() - start_time) // 1_000_000
 
     # Return the JSON response
-    return {'time_elapsed': f'{int(time_taken)} ms', 'grayscale_image_size': f'{grayscale_image_size:.2f} KB', 'grayscale_image_base64': grayscale_image_base64}, 200
+    return {'time_elapsed': f'{time_taken} ms', 'grayscale_image_size': f'{grayscale_image_size:.2f} KB', 'grayscale_image_base64': grayscale_image_base64}, 200
   except Exception as e:
     return {'error': f'An error occured: {str(e)}'}, 500
 
@@ -263,14 +455,13 @@ def get_images():
   images = []
 
   try:
-    # Iterate over all files in the images directory
-    for filename in os.listdir("images"):
-      if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
-        # Construct the path to the image in the 'images' folder
-        image_path = os.path.join('images', filename)
-        image_size_kb = int(os.path.getsize(image_path) / 1024)
-        image_detail = {'image_name': filename, 'image_size': f'{image_size_kb} KB'}
-        images.append(image_detail)
+    # Iterate over all files in the images directory (scandir caches the stat result per entry)
+    with os.scandir(IMAGES_DIR) as entries:
+      for entry in entries:
+        if entry.is_file() and os.path.splitext(entry.name)[1].lower() in ALLOWED_EXTENSIONS:
+          image_size_kb = int(entry.stat().st_size / 1024)
+          image_detail = {'image_name': entry.name, 'image_size': f'{image_size_kb} KB'}
+          images.append(image_detail)
 
     return images    
   except Exception as e: